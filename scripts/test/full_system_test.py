@@ -4,16 +4,39 @@ Keen-One Astronomy Stack - Full System Test
 Tests all components of the astronomy stack end-to-end
 """
 
-import socket
-import time
-import re
+import asyncio
+import shutil
 import sys
 import subprocess
+from typing import Dict, List
+
+from test_indi import ABORT_XML, GET_PROPS, INDIClient, MOUNT_DEVICE, hms, run
 
 INDI_HOST = "localhost"
 INDI_PORT = 7624
-MOUNT_DEVICE = "LX200 OnStep"
 TIMEOUT = 10
+# Local ports either answer within milliseconds or are down
+PROBE_TIMEOUT = 1.0
+
+DESKTOP_CONTAINER = "astronomy-desktop"
+# Resolved once rather than searched on PATH for every call
+_DOCKER = shutil.which("docker") or "docker"
+
+# Shell checks run inside the desktop container in a single docker exec
+DESKTOP_CHECKS = {
+    "indi_access": "nc -z indiserver 7624 && echo PASS || echo FAIL",
+    "stellarium_cfg": "cat /config/.stellarium/modules/TelescopeControl/telescopes.ini 2>/dev/null",
+    "kstars_cfg": "cat /config/.local/share/kstars/ekos_profiles.xml 2>/dev/null",
+    "software": 'for b in stellarium kstars indi_getprop; do command -v "$b" || echo "MISSING:$b"; done',
+}
+BATCH_SEP = b"__SEP__"
+
+# Output of DESKTOP_CHECKS keyed by check name, filled in once by main()
+_desktop_output = {}
+_desktop_error = None
+
+# Shared INDI connection, created by main() and opened by test_indi_connection()
+client = None
 
 class Colors:
     GREEN = ""
@@ -39,154 +62,139 @@ def print_warn(msg):
 def print_info(msg):
     print(f"  [INFO] {msg}")
 
-def send_indi_command(host, port, command, timeout=5, wait_time=1.0):
-    """Send command to INDI server and get response."""
+async def send_indi_command(command, until=None):
+    """Send command over the shared INDI connection and get response."""
     try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(timeout)
-        sock.connect((host, port))
-        sock.sendall(command.encode())
-        time.sleep(wait_time)  # Wait for response
-
-        response = b""
-        sock.setblocking(False)
-        try:
-            while True:
-                try:
-                    chunk = sock.recv(8192)
-                    if not chunk:
-                        break
-                    response += chunk
-                except BlockingIOError:
-                    break
-        finally:
-            sock.setblocking(True)
-
-        sock.close()
-        return response.decode('utf-8', errors='ignore')
+        return await client.send(command, until=until)
     except Exception as e:
         return f"ERROR: {e}"
 
-def test_docker_containers():
+def docker_ps_snapshot() -> Dict[str, str]:
+    """Return {container name: status} for running containers."""
+    result = subprocess.run(
+        [_DOCKER, "ps", "--format", "{{.Names}}\t{{.Status}}"],
+        capture_output=True, timeout=10
+    )
+
+    containers = {}
+    for line in result.stdout.decode(errors="replace").splitlines():
+        name, sep, status = line.partition('\t')
+        if not sep:
+            continue
+        containers[name] = status
+    return containers
+
+async def probe(host, port, timeout=PROBE_TIMEOUT):
+    """Return True if a TCP connection to host:port succeeds."""
+    try:
+        _, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port), timeout
+        )
+        writer.close()
+        await writer.wait_closed()
+        return True
+    except (OSError, asyncio.TimeoutError):
+        return False
+
+def test_docker_containers(containers, error):
     """Test that Docker containers are running."""
     print("Test 1: Docker Containers")
     print("-" * 40)
 
-    try:
-        result = subprocess.run(
-            ["docker", "ps", "--format", "{{.Names}}\t{{.Status}}"],
-            capture_output=True, text=True, timeout=10
-        )
+    if error:
+        print_fail(f"Docker check failed: {error}")
+        return False
 
-        containers = result.stdout.strip().split('\n')
-        found_indi = False
-        found_desktop = False
+    indi_status = containers.get("indiserver")
+    desktop_status = containers.get(DESKTOP_CONTAINER)
 
-        for line in containers:
-            if "indiserver" in line:
-                found_indi = True
-                print_pass(f"indiserver: {line.split(chr(9))[1] if chr(9) in line else 'running'}")
-            if "astronomy-desktop" in line:
-                found_desktop = True
-                print_pass(f"astronomy-desktop: {line.split(chr(9))[1] if chr(9) in line else 'running'}")
+    if indi_status:
+        print_pass(f"indiserver: {indi_status}")
+    else:
+        print_fail("indiserver container not found")
 
-        if not found_indi:
-            print_fail("indiserver container not found")
-        if not found_desktop:
-            print_fail("astronomy-desktop container not found")
+    if desktop_status:
+        print_pass(f"{DESKTOP_CONTAINER}: {desktop_status}")
+    else:
+        print_fail(f"{DESKTOP_CONTAINER} container not found")
 
-        return found_indi and found_desktop
-    except Exception as e:
-        print_fail(f"Docker check failed: {e}")
-        return False
+    return bool(indi_status and desktop_status)
 
-def test_indi_connection():
+async def test_indi_connection():
     """Test INDI server connectivity."""
+    # Opening the shared client doubles as the port probe
+    try:
+        await client.open(timeout=PROBE_TIMEOUT)
+        connected = True
+    except (OSError, asyncio.TimeoutError):
+        connected = False
+
     print("\nTest 2: INDI Server Connection")
     print("-" * 40)
 
-    try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(5)
-        result = sock.connect_ex((INDI_HOST, INDI_PORT))
-        sock.close()
-
-        if result == 0:
-            print_pass(f"Connected to {INDI_HOST}:{INDI_PORT}")
-            return True
-        else:
-            print_fail(f"Cannot connect to {INDI_HOST}:{INDI_PORT}")
-            return False
-    except Exception as e:
-        print_fail(f"Connection error: {e}")
+    if connected:
+        print_pass(f"Connected to {INDI_HOST}:{INDI_PORT}")
+        return True
+    else:
+        print_fail(f"Cannot connect to {INDI_HOST}:{INDI_PORT}")
         return False
 
-def test_indi_driver():
+async def test_indi_driver():
     """Test that INDI driver is loaded."""
+    # Stop reading as soon as the connection state and position are known
+    response = await send_indi_command(GET_PROPS, until=client.state.mount_known)
+    state = client.state
+
     print("\nTest 3: INDI Driver Status")
     print("-" * 40)
 
-    response = send_indi_command(INDI_HOST, INDI_PORT, '<getProperties version="1.7"/>')
-
-    if "ERROR" in response:
+    if response.startswith("ERROR"):
         print_fail(f"Failed to query INDI: {response}")
         return False, None
 
-    if MOUNT_DEVICE in response:
+    if MOUNT_DEVICE in state.devices:
         print_pass(f"{MOUNT_DEVICE} driver loaded")
 
         # Check connection status
-        if 'name="CONNECT"' in response:
-            # Find connection state
-            connect_section = response.split('name="CONNECT"')[1][:200]
-            if ">On<" in connect_section or "On\n" in connect_section:
-                print_pass("Mount is CONNECTED")
-            else:
-                print_warn("Mount driver loaded but not connected to hardware")
-
-        return True, response
+        if state.connected:
+            print_pass("Mount is CONNECTED")
+        elif state.connected is not None:
+            print_warn("Mount driver loaded but not connected to hardware")
+
+        return True, state
     else:
         print_fail(f"{MOUNT_DEVICE} driver not found")
-        return False, response
+        return False, state
 
-def test_mount_coordinates(indi_response):
+def test_mount_coordinates(indi_state):
     """Test reading mount coordinates."""
     print("\nTest 4: Mount Coordinates")
     print("-" * 40)
 
-    if not indi_response:
+    if not indi_state:
         print_fail("No INDI response to parse")
         return None, None
 
-    # Extract RA
-    ra_match = re.search(r'name="RA"[^>]*>[\s\n]*([\d.]+)', indi_response)
-    dec_match = re.search(r'name="DEC"[^>]*>[\s\n]*([-\d.]+)', indi_response)
-
-    if ra_match and dec_match:
-        ra = float(ra_match.group(1))
-        dec = float(dec_match.group(1))
+    if indi_state.ra is not None and indi_state.dec is not None:
+        ra = indi_state.ra
+        dec = indi_state.dec
 
         # Convert to readable format
-        ra_h = int(ra)
-        ra_m = int((ra - ra_h) * 60)
-        ra_s = int(((ra - ra_h) * 60 - ra_m) * 60)
-
-        dec_d = int(dec)
-        dec_m = abs(int((dec - dec_d) * 60))
+        ra_h, ra_m, ra_s = hms(ra)
+        dec_d, dec_m, _ = hms(dec)
 
         print_pass(f"RA:  {ra_h}h {ra_m}m {ra_s}s ({ra:.4f})")
-        print_pass(f"Dec: {dec_d}d {dec_m}' ({dec:.4f})")
+        print_pass(f"Dec: {dec_d}d {abs(dec_m)}' ({dec:.4f})")
         return ra, dec
     else:
         print_warn("Could not read coordinates (mount may not be connected)")
         return None, None
 
-def test_slew_command(current_ra, current_dec):
+async def test_slew_command(current_ra, current_dec):
     """Test sending a slew command."""
-    print("\nTest 5: Slew Command")
-    print("-" * 40)
-
     if current_ra is None:
+        print("\nTest 5: Slew Command")
+        print("-" * 40)
         print_warn("Skipping slew test - no current coordinates")
         return False
 
@@ -194,65 +202,122 @@ def test_slew_command(current_ra, current_dec):
     target_ra = current_ra + 0.01  # Move slightly in RA
     target_dec = current_dec
 
-    print_info(f"Sending slew to RA={target_ra:.4f}, Dec={target_dec:.4f}")
-
     slew_cmd = f'''<newNumberVector device="{MOUNT_DEVICE}" name="EQUATORIAL_EOD_COORD">
   <oneNumber name="RA">{target_ra}</oneNumber>
   <oneNumber name="DEC">{target_dec}</oneNumber>
-</newNumberVector>'''
+</newNumberVector>'''.encode()
 
-    response = send_indi_command(INDI_HOST, INDI_PORT, slew_cmd, timeout=5, wait_time=1.5)
+    response = await send_indi_command(slew_cmd)
 
-    # Check for Busy state (mount is slewing) or Ok state (command accepted)
-    if 'state="Busy"' in response or "Busy" in response:
-        print_pass("Slew command accepted (state: Busy)")
+    # Judge the slew only by EQUATORIAL_EOD_COORD updates sent after it
+    if response.startswith("ERROR") or not client.coord_updated():
+        coord_state = None
+    else:
+        coord_state = client.state.coord_state
 
+    if coord_state == "Busy":
         # Wait and check for completion
-        time.sleep(2)
+        await asyncio.sleep(2)
 
         # Abort the slew
-        abort_cmd = f'''<newSwitchVector device="{MOUNT_DEVICE}" name="TELESCOPE_ABORT_MOTION">
-  <oneSwitch name="ABORT">On</oneSwitch>
-</newSwitchVector>'''
-        send_indi_command(INDI_HOST, INDI_PORT, abort_cmd, timeout=2)
+        await send_indi_command(ABORT_XML)
+
+    # Print only once all I/O is done so output doesn't interleave
+    # with the tests running concurrently
+    print("\nTest 5: Slew Command")
+    print("-" * 40)
+    print_info(f"Sending slew to RA={target_ra:.4f}, Dec={target_dec:.4f}")
+
+    if coord_state == "Busy":
+        print_pass("Slew command accepted (state: Busy)")
         print_info("Slew aborted after test")
         return True
-    elif 'state="Ok"' in response or "Ok" in response:
+    elif coord_state == "Ok":
         print_pass("Slew command completed")
         return True
-    elif "EQUATORIAL" in response:
-        # Response contains coordinate update, command was accepted
-        print_pass("Slew command sent (coordinate update received)")
-        # Abort the slew
-        abort_cmd = f'''<newSwitchVector device="{MOUNT_DEVICE}" name="TELESCOPE_ABORT_MOTION">
-  <oneSwitch name="ABORT">On</oneSwitch>
-</newSwitchVector>'''
-        send_indi_command(INDI_HOST, INDI_PORT, abort_cmd, timeout=2)
-        return True
+    elif coord_state == "Alert":
+        print_fail("Slew command rejected (state: Alert)")
+        return False
     else:
         print_warn("Slew response unclear - mount may not be connected")
         return False
 
+async def test_mount():
+    """Run the dependent INDI tests (connection -> driver -> coordinates -> slew)."""
+    results = {}
+    results["indi_conn"] = await test_indi_connection()
+
+    # Nothing INDI-related can pass without the server; the results
+    # main() starts from already record the skipped tests as failed
+    if not results["indi_conn"]:
+        print_warn("Skipping driver, coordinate and slew tests")
+        return results
+
+    driver_ok, indi_state = await test_indi_driver()
+    results["indi_driver"] = driver_ok
+
+    if driver_ok:
+        ra, dec = test_mount_coordinates(indi_state)
+        results["coordinates"] = ra is not None
+        results["slew"] = await test_slew_command(ra, dec)
+    else:
+        results["coordinates"] = False
+        results["slew"] = False
+
+    return results
+
+async def docker_exec_batch(container, commands: List[str]) -> List[bytes]:
+    """Run several shell commands in one docker exec and split their output."""
+    joined = f"; printf '\\n{BATCH_SEP.decode()}\\n'; ".join(commands)
+    proc = await asyncio.create_subprocess_exec(
+        _DOCKER, "exec", container, "sh", "-c", joined,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    try:
+        stdout, _ = await asyncio.wait_for(proc.communicate(), timeout=10)
+    except (asyncio.TimeoutError, asyncio.CancelledError):
+        # Don't leave docker exec running once nobody wants its output
+        proc.kill()
+        await proc.wait()
+        raise
+
+    # Output stays bytes: config files aren't guaranteed to be UTF-8
+    sections = stdout.split(b"\n" + BATCH_SEP + b"\n")
+    # A failed exec produces fewer sections than commands
+    sections += [b""] * (len(commands) - len(sections))
+    return sections
+
+async def run_desktop_checks(containers):
+    """Run all astronomy-desktop checks and cache their output."""
+    global _desktop_error
+
+    # Skip the exec entirely when the container isn't running
+    if DESKTOP_CONTAINER not in containers:
+        _desktop_error = f"{DESKTOP_CONTAINER} container not running"
+        return
+
+    try:
+        sections = await docker_exec_batch(
+            DESKTOP_CONTAINER, list(DESKTOP_CHECKS.values())
+        )
+        _desktop_output.update(zip(DESKTOP_CHECKS, sections))
+    except Exception as e:
+        _desktop_error = e
+
 def test_container_indi_access():
     """Test INDI access from astronomy-desktop container."""
     print("\nTest 6: Container INDI Access")
     print("-" * 40)
 
-    try:
-        result = subprocess.run(
-            ["docker", "exec", "astronomy-desktop", "sh", "-c",
-             "nc -z indiserver 7624 && echo PASS || echo FAIL"],
-            capture_output=True, text=True, timeout=10
-        )
+    if _desktop_error:
+        print_fail(f"Container test failed: {_desktop_error}")
+        return False
 
-        if "PASS" in result.stdout:
-            print_pass("astronomy-desktop can reach indiserver:7624")
-            return True
-        else:
-            print_fail("astronomy-desktop cannot reach indiserver")
-            return False
-    except Exception as e:
-        print_fail(f"Container test failed: {e}")
+    if b"PASS" in _desktop_output["indi_access"]:
+        print_pass("astronomy-desktop can reach indiserver:7624")
+        return True
+    else:
+        print_fail("astronomy-desktop cannot reach indiserver")
         return False
 
 def test_stellarium_config():
@@ -260,23 +325,19 @@ def test_stellarium_config():
     print("\nTest 7: Stellarium Configuration")
     print("-" * 40)
 
-    try:
-        result = subprocess.run(
-            ["docker", "exec", "astronomy-desktop", "sh", "-c",
-             "cat /config/.stellarium/modules/TelescopeControl/telescopes.ini 2>/dev/null"],
-            capture_output=True, text=True, timeout=10
-        )
+    if _desktop_error:
+        print_fail(f"Config check failed: {_desktop_error}")
+        return False
 
-        if "LX200 OnStep" in result.stdout and "indiserver" in result.stdout:
-            print_pass("Stellarium telescope config correct")
-            print_info("  - Connection: INDI to indiserver:7624")
-            print_info("  - Device: LX200 OnStep")
-            return True
-        else:
-            print_fail("Stellarium telescope config missing or incorrect")
-            return False
-    except Exception as e:
-        print_fail(f"Config check failed: {e}")
+    output = _desktop_output["stellarium_cfg"]
+
+    if b"LX200 OnStep" in output and b"indiserver" in output:
+        print_pass("Stellarium telescope config correct")
+        print_info("  - Connection: INDI to indiserver:7624")
+        print_info("  - Device: LX200 OnStep")
+        return True
+    else:
+        print_fail("Stellarium telescope config missing or incorrect")
         return False
 
 def test_kstars_config():
@@ -284,24 +345,20 @@ def test_kstars_config():
     print("\nTest 8: KStars/Ekos Configuration")
     print("-" * 40)
 
-    try:
-        result = subprocess.run(
-            ["docker", "exec", "astronomy-desktop", "sh", "-c",
-             "cat /config/.local/share/kstars/ekos_profiles.xml 2>/dev/null"],
-            capture_output=True, text=True, timeout=10
-        )
+    if _desktop_error:
+        print_fail(f"Config check failed: {_desktop_error}")
+        return False
 
-        if "Keen-One EQ" in result.stdout and "LX200 OnStep" in result.stdout:
-            print_pass("KStars Ekos profile correct")
-            print_info("  - Profile: Keen-One EQ")
-            print_info("  - Auto-connect: Enabled")
-            print_info("  - Remote INDI: indiserver:7624")
-            return True
-        else:
-            print_fail("KStars Ekos profile missing or incorrect")
-            return False
-    except Exception as e:
-        print_fail(f"Config check failed: {e}")
+    output = _desktop_output["kstars_cfg"]
+
+    if b"Keen-One EQ" in output and b"LX200 OnStep" in output:
+        print_pass("KStars Ekos profile correct")
+        print_info("  - Profile: Keen-One EQ")
+        print_info("  - Auto-connect: Enabled")
+        print_info("  - Remote INDI: indiserver:7624")
+        return True
+    else:
+        print_fail("KStars Ekos profile missing or incorrect")
         return False
 
 def test_software_installed():
@@ -309,86 +366,85 @@ def test_software_installed():
     print("\nTest 9: Software Installation")
     print("-" * 40)
 
-    try:
-        result = subprocess.run(
-            ["docker", "exec", "astronomy-desktop", "sh", "-c",
-             "which stellarium kstars indi_getprop 2>/dev/null"],
-            capture_output=True, text=True, timeout=10
-        )
+    if _desktop_error:
+        print_fail(f"Software check failed: {_desktop_error}")
+        return False
 
-        output = result.stdout.strip()
+    # One line per binary: its resolved path, or MISSING:<name>
+    installed = set()
+    for line in _desktop_output["software"].splitlines():
+        if line and not line.startswith(b"MISSING:"):
+            installed.add(line.rsplit(b"/", 1)[-1])
 
-        if "stellarium" in output:
-            print_pass("Stellarium installed")
-        else:
-            print_fail("Stellarium not found")
+    if b"stellarium" in installed:
+        print_pass("Stellarium installed")
+    else:
+        print_fail("Stellarium not found")
 
-        if "kstars" in output:
-            print_pass("KStars installed")
-        else:
-            print_fail("KStars not found")
+    if b"kstars" in installed:
+        print_pass("KStars installed")
+    else:
+        print_fail("KStars not found")
 
-        if "indi_getprop" in output:
-            print_pass("INDI tools installed")
-        else:
-            print_warn("INDI tools not found (optional)")
+    if b"indi_getprop" in installed:
+        print_pass("INDI tools installed")
+    else:
+        print_warn("INDI tools not found (optional)")
 
-        return "stellarium" in output and "kstars" in output
-    except Exception as e:
-        print_fail(f"Software check failed: {e}")
-        return False
+    return b"stellarium" in installed and b"kstars" in installed
 
-def test_web_desktop():
+def test_web_desktop(accessible):
     """Test web desktop is accessible."""
     print("\nTest 10: Web Desktop Access")
     print("-" * 40)
 
-    try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(5)
-        result = sock.connect_ex(("localhost", 3000))
-        sock.close()
-
-        if result == 0:
-            print_pass("Web desktop accessible at http://localhost:3000")
-            return True
-        else:
-            print_fail("Web desktop not accessible on port 3000")
-            return False
-    except Exception as e:
-        print_fail(f"Web desktop check failed: {e}")
+    if accessible:
+        print_pass("Web desktop accessible at http://localhost:3000")
+        return True
+    else:
+        print_fail("Web desktop not accessible on port 3000")
         return False
 
-def main():
+RESULT_NAMES = [
+    "docker", "indi_conn", "indi_driver", "coordinates", "slew",
+    "container_indi", "stellarium_cfg", "kstars_cfg", "software", "web_desktop",
+]
+
+async def main():
+    global client
+
     print_header("KEEN-ONE ASTRONOMY STACK - FULL SYSTEM TEST")
 
-    results = {}
+    # Tests skipped by an early failure are reported as failed
+    results = dict.fromkeys(RESULT_NAMES, False)
 
-    # Run all tests
-    results["docker"] = test_docker_containers()
-    results["indi_conn"] = test_indi_connection()
-
-    if results["indi_conn"]:
-        driver_ok, indi_response = test_indi_driver()
-        results["indi_driver"] = driver_ok
-
-        if driver_ok:
-            ra, dec = test_mount_coordinates(indi_response)
-            results["coordinates"] = ra is not None
-            results["slew"] = test_slew_command(ra, dec)
-        else:
-            results["coordinates"] = False
-            results["slew"] = False
-    else:
-        results["indi_driver"] = False
-        results["coordinates"] = False
-        results["slew"] = False
+    # docker ps runs once; the container checks reuse its result or error
+    try:
+        containers, docker_error = docker_ps_snapshot(), None
+    except Exception as e:
+        containers, docker_error = {}, e
+    results["docker"] = test_docker_containers(containers, docker_error)
+
+    # Independent checks run concurrently. The INDI tests print as they
+    # complete; the desktop container and web desktop results are
+    # collected here and reported below. Each check skips what depends on
+    # a missing prerequisite, so one failure doesn't hide unrelated results.
+    client = INDIClient(INDI_HOST, INDI_PORT)
+    try:
+        mount, _, web_accessible = await asyncio.gather(
+            test_mount(),
+            run_desktop_checks(containers),
+            probe("localhost", 3000),
+        )
+    finally:
+        await client.disconnect()
 
+    results.update(mount)
     results["container_indi"] = test_container_indi_access()
     results["stellarium_cfg"] = test_stellarium_config()
     results["kstars_cfg"] = test_kstars_config()
     results["software"] = test_software_installed()
-    results["web_desktop"] = test_web_desktop()
+    results["web_desktop"] = test_web_desktop(web_accessible)
 
     # Summary
     print_header("TEST SUMMARY")
@@ -413,4 +469,4 @@ def main():
     return 0 if passed == total else 1
 
 if __name__ == "__main__":
-    sys.exit(main())
+    sys.exit(run(main()))
@@ -4,11 +4,16 @@ INDI Stack Test Script
 Tests INDI server connectivity and telescope control from the host machine.
 """
 
-import socket
+import asyncio
 import sys
-import time
 import xml.etree.ElementTree as ET
-from typing import Optional, Tuple
+from typing import Callable, Optional, Tuple
+
+# Optional: faster event loop (pip install uvloop)
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 # Configuration
 INDI_HOST = "localhost"  # From host perspective
@@ -16,6 +21,94 @@ INDI_PORT = 7624
 MOUNT_DEVICE = "LX200 OnStep"
 TIMEOUT = 10
 
+# Fixed INDI messages, encoded once
+GET_PROPS = b'<getProperties version="1.7"/>'
+ABORT_XML = f'''<newSwitchVector device="{MOUNT_DEVICE}" name="TELESCOPE_ABORT_MOTION">
+  <oneSwitch name="ABORT">On</oneSwitch>
+</newSwitchVector>'''.encode()
+
+
+class INDIState:
+    """Incremental parser for the XML stream sent by the INDI server."""
+
+    def __init__(self):
+        self._reset_parser()
+        self.devices = set()
+        self.connected: Optional[bool] = None
+        self.ra: Optional[float] = None
+        self.dec: Optional[float] = None
+        # state attribute of the last EQUATORIAL_EOD_COORD vector seen
+        self.coord_state: Optional[str] = None
+        # setNumberVector EQUATORIAL_EOD_COORD updates received so far
+        self.coord_updates = 0
+
+    def _reset_parser(self):
+        # INDI sends a sequence of XML fragments, so wrap them in one root
+        self._parser = ET.XMLPullParser(["start", "end"])
+        self._parser.feed(b"<root>")
+        # Newlines fed so far, to locate parse errors within a chunk
+        self._lines = 0
+        self._root: Optional[ET.Element] = None
+        self._depth = 0
+        self._vector: Optional[str] = None
+
+    def feed(self, data: bytes):
+        """Parse a chunk of the stream and update the mount state."""
+        while data:
+            try:
+                # XMLPullParser reports syntax errors from read_events(), not feed()
+                self._parser.feed(data)
+                for event, elem in self._parser.read_events():
+                    self._handle(event, elem)
+                self._lines += data.count(b"\n")
+                return
+            except ET.ParseError as e:
+                # The parser can't recover from an error, so start a fresh
+                # stream at the line after the malformed fragment
+                line = max(e.position[0] - 1 - self._lines, 0)
+                data = b"".join(data.split(b"\n", line + 1)[line + 1:])
+                self._reset_parser()
+
+    def _handle(self, event: str, elem: ET.Element):
+        if event == "start":
+            self._depth += 1
+            if self._root is None:
+                self._root = elem
+            elif self._depth == 2:
+                device = elem.get("device")
+                if device:
+                    self.devices.add(device)
+                self._vector = elem.get("name") if device == MOUNT_DEVICE else None
+            return
+
+        self._depth -= 1
+        name = elem.get("name")
+        if self._vector == "EQUATORIAL_EOD_COORD" and elem.tag in ("defNumber", "oneNumber"):
+            try:
+                if name == "RA":
+                    self.ra = float(elem.text)
+                elif name == "DEC":
+                    self.dec = float(elem.text)
+            except (TypeError, ValueError):
+                pass
+        elif self._vector == "CONNECTION" and elem.tag in ("defSwitch", "oneSwitch"):
+            if name == "CONNECT":
+                self.connected = (elem.text or "").strip() == "On"
+        elif self._depth == 1:
+            # A vector is complete only at its end event, once RA/DEC are set
+            if self._vector == "EQUATORIAL_EOD_COORD":
+                if elem.get("state"):
+                    self.coord_state = elem.get("state")
+                if elem.tag == "setNumberVector":
+                    self.coord_updates += 1
+            # Drop finished top-level elements so the tree doesn't grow
+            self._vector = None
+            self._root.clear()
+
+    def mount_known(self) -> bool:
+        """True once the mount's connection state and position have been seen."""
+        return self.connected is not None and self.ra is not None and self.dec is not None
+
 
 class INDIClient:
     """Simple INDI client for testing telescope control."""
@@ -23,98 +116,157 @@ class INDIClient:
     def __init__(self, host: str = INDI_HOST, port: int = INDI_PORT):
         self.host = host
         self.port = port
-        self.socket: Optional[socket.socket] = None
-
-    def connect(self) -> bool:
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.state = INDIState()
+        # Set when send() stopped before the server finished answering
+        self._unread = False
+        # state.coord_updates when the last message was written
+        self._sent_coord_updates = 0
+
+    async def open(self, timeout: float = TIMEOUT):
+        """Open the connection, raising on failure."""
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), timeout
+        )
+        self.state = INDIState()
+        self._unread = False
+
+    async def connect(self) -> bool:
         """Connect to INDI server."""
         try:
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket.settimeout(TIMEOUT)
-            self.socket.connect((self.host, self.port))
+            await self.open()
             return True
         except Exception as e:
             print(f"❌ Connection failed: {e}")
             return False
 
-    def disconnect(self):
+    async def disconnect(self):
         """Disconnect from INDI server."""
-        if self.socket:
-            self.socket.close()
-            self.socket = None
-
-    def send(self, message: str) -> str:
-        """Send message and receive response."""
-        if not self.socket:
+        if self.writer:
+            self.writer.close()
+            await self.writer.wait_closed()
+            self.reader = None
+            self.writer = None
+
+    async def __aenter__(self) -> "INDIClient":
+        if not self.writer:
+            await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.disconnect()
+
+    async def send(self, message: bytes, first_timeout: float = 1.0,
+                   read_timeout: float = 0.05,
+                   until: Optional[Callable[[], bool]] = None) -> str:
+        """Send message and receive response.
+
+        Waits up to ``first_timeout`` for the first chunk (the driver may
+        need to wake up), then keeps reading until the server has been
+        quiet for ``read_timeout``. With ``until``, gaps of up to
+        ``first_timeout`` are tolerated and reading stops early once
+        ``until()`` is True or after ``TIMEOUT`` seconds; the rest of that
+        answer is drained before the next message.
+        """
+        if not self.writer:
             raise RuntimeError("Not connected")
 
-        self.socket.sendall(message.encode())
-        time.sleep(0.5)  # Wait for response
-
-        # Receive response
-        response = b""
-        self.socket.setblocking(False)
-        try:
-            while True:
-                try:
-                    chunk = self.socket.recv(4096)
-                    if not chunk:
-                        break
-                    response += chunk
-                except BlockingIOError:
-                    break
-        finally:
-            self.socket.setblocking(True)
+        # Don't let the tail of an earlier answer pass as this reply
+        if self._unread:
+            await self._receive(read_timeout, read_timeout)
+
+        self._sent_coord_updates = self.state.coord_updates
+        self.writer.write(message)
+        await self.writer.drain()
+        return await self._receive(first_timeout, read_timeout, until)
+
+    async def _receive(self, first_timeout: float, read_timeout: float,
+                       until: Optional[Callable[[], bool]] = None) -> str:
+        """Read and parse chunks until the server goes quiet or until() is True."""
+        response = bytearray()
+        timeout = first_timeout
+        self._unread = False
+        # Other drivers may keep pushing updates, so bound the whole read
+        deadline = asyncio.get_running_loop().time() + TIMEOUT
+        while True:
+            remaining = deadline - asyncio.get_running_loop().time()
+            try:
+                chunk = await asyncio.wait_for(self.reader.read(8192),
+                                               timeout=min(timeout, remaining))
+            except asyncio.TimeoutError:
+                # Stopped by the deadline rather than a quiet server
+                self._unread = remaining <= timeout
+                break
+            if not chunk:
+                break
+            response += chunk
+            self.state.feed(chunk)
+            if until and until():
+                self._unread = True
+                break
+            # The rest of a response arrives back-to-back, except that other
+            # drivers may answer before the one until() is waiting for
+            timeout = first_timeout if until else read_timeout
 
         return response.decode('utf-8', errors='ignore')
 
-    def get_properties(self) -> str:
-        """Get all INDI properties."""
-        return self.send('<getProperties version="1.7"/>')
+    def coord_updated(self) -> bool:
+        """True if EQUATORIAL_EOD_COORD was updated after the last message sent."""
+        return self.state.coord_updates > self._sent_coord_updates
 
-    def get_coordinates(self, response: str) -> Tuple[Optional[float], Optional[float]]:
-        """Parse RA/DEC from INDI response."""
-        try:
-            # Find RA
-            ra_start = response.find('name="RA"')
-            if ra_start > 0:
-                ra_section = response[ra_start:ra_start+200]
-                # Extract number
-                import re
-                ra_match = re.search(r'>\s*([\d.]+)\s*<', ra_section)
-                ra = float(ra_match.group(1)) if ra_match else None
-            else:
-                ra = None
-
-            # Find DEC
-            dec_start = response.find('name="DEC"')
-            if dec_start > 0:
-                dec_section = response[dec_start:dec_start+200]
-                dec_match = re.search(r'>\s*([-\d.]+)\s*<', dec_section)
-                dec = float(dec_match.group(1)) if dec_match else None
-            else:
-                dec = None
+    async def read_update(self) -> str:
+        """Wait for the next property update pushed by the server."""
+        if not self.reader:
+            raise RuntimeError("Not connected")
 
-            return ra, dec
-        except Exception:
-            return None, None
+        chunk = await self.reader.read(8192)
+        if not chunk:
+            raise ConnectionError("INDI server closed the connection")
+        self.state.feed(chunk)
+        return chunk.decode('utf-8', errors='ignore')
+
+    async def get_properties(self, until: Optional[Callable[[], bool]] = None) -> str:
+        """Get all INDI properties."""
+        return await self.send(GET_PROPS, until=until)
 
-    def slew_to(self, ra: float, dec: float) -> str:
+    def get_coordinates(self) -> Tuple[Optional[float], Optional[float]]:
+        """Return the last RA/DEC reported by the mount."""
+        return self.state.ra, self.state.dec
+
+    async def slew_to(self, ra: float, dec: float) -> str:
         """Send slew command to telescope."""
         cmd = f'''<newNumberVector device="{MOUNT_DEVICE}" name="EQUATORIAL_EOD_COORD">
   <oneNumber name="RA">{ra}</oneNumber>
   <oneNumber name="DEC">{dec}</oneNumber>
 </newNumberVector>'''
-        return self.send(cmd)
+        return await self.send(cmd.encode())
 
-    def abort_slew(self) -> str:
+    async def abort_slew(self) -> str:
         """Abort current slew."""
-        cmd = f'''<newSwitchVector device="{MOUNT_DEVICE}" name="TELESCOPE_ABORT_MOTION">
-  <oneSwitch name="ABORT">On</oneSwitch>
-</newSwitchVector>'''
-        return self.send(cmd)
+        return await self.send(ABORT_XML)
+
 
+def hms(x: float) -> Tuple[int, int, int]:
+    """Split decimal hours/degrees into whole units, minutes and seconds."""
+    h = int(x)
+    m_f = (x - h) * 60
+    m = int(m_f)
+    s = int((m_f - m) * 60)
+    return h, m, s
 
-def run_tests():
+
+def run(coro):
+    """Run a coroutine on uvloop when it is installed, else the default loop."""
+    if uvloop is not None:
+        # uvloop.run() was added in uvloop 0.18
+        if hasattr(uvloop, "run"):
+            return uvloop.run(coro)
+        uvloop.install()
+    return asyncio.run(coro)
+
+
+async def run_tests():
     """Run all INDI tests."""
     print("=" * 50)
     print("  INDI Telescope Control Test Suite")
@@ -127,7 +279,7 @@ def run_tests():
 
     # Test 1: Connection
     print("Test 1: INDI Server Connection...", end=" ")
-    if client.connect():
+    if await client.connect():
         print("[PASS]")
         passed += 1
     else:
@@ -136,68 +288,65 @@ def run_tests():
         print("\nCannot continue without connection.")
         return False
 
-    # Test 2: Get Properties
-    print("Test 2: Get INDI Properties...", end=" ")
-    try:
-        response = client.get_properties()
-        if MOUNT_DEVICE in response:
-            print(f"✅ PASS - {MOUNT_DEVICE} found")
-            passed += 1
-        else:
-            print("❌ FAIL - Mount device not found")
+    async with client:
+        # Test 2: Get Properties
+        print("Test 2: Get INDI Properties...", end=" ")
+        try:
+            await client.get_properties(until=client.state.mount_known)
+            if MOUNT_DEVICE in client.state.devices:
+                print(f"✅ PASS - {MOUNT_DEVICE} found")
+                passed += 1
+            else:
+                print("❌ FAIL - Mount device not found")
+                failed += 1
+        except Exception as e:
+            print(f"❌ FAIL - {e}")
             failed += 1
-    except Exception as e:
-        print(f"❌ FAIL - {e}")
-        failed += 1
 
-    # Test 3: Check Connection Status
-    print("Test 3: Mount Connection Status...", end=" ")
-    if 'name="CONNECT"' in response:
-        if ">On<" in response.split('name="CONNECT"')[1][:100]:
+        # Test 3: Check Connection Status
+        print("Test 3: Mount Connection Status...", end=" ")
+        if client.state.connected is None:
+            print("❌ FAIL - Cannot determine status")
+            failed += 1
+        elif client.state.connected:
             print("✅ PASS - Mount connected")
             passed += 1
         else:
             print("⚠️  WARN - Mount not connected")
             passed += 1  # Not a failure, just a state
-    else:
-        print("❌ FAIL - Cannot determine status")
-        failed += 1
-
-    # Test 4: Read Coordinates
-    print("Test 4: Read Current Position...", end=" ")
-    ra, dec = client.get_coordinates(response)
-    if ra is not None and dec is not None:
-        ra_h = int(ra)
-        ra_m = int((ra - ra_h) * 60)
-        dec_d = int(dec)
-        dec_m = abs(int((dec - dec_d) * 60))
-        print(f"✅ PASS - RA: {ra_h}h{ra_m}m, Dec: {dec_d}°{dec_m}'")
-        passed += 1
-    else:
-        print("⚠️  WARN - Could not read coordinates")
-
-    # Test 5: Slew Command (small offset)
-    print("Test 5: Slew Command Test...", end=" ")
-    if ra is not None and dec is not None:
-        # Slew to current position + tiny offset (won't move much)
-        test_ra = ra + 0.001
-        test_dec = dec
-        try:
-            slew_response = client.slew_to(test_ra, test_dec)
-            if "Busy" in slew_response or "Ok" in slew_response:
-                print("✅ PASS - Slew command accepted")
-                passed += 1
-                # Abort the slew
-                client.abort_slew()
-            else:
-                print("⚠️  WARN - Slew response unclear")
-        except Exception as e:
-            print(f"❌ FAIL - {e}")
-            failed += 1
-    else:
-        print("⏭️  SKIP - No coordinates available")
 
-    client.disconnect()
+        # Test 4: Read Coordinates
+        print("Test 4: Read Current Position...", end=" ")
+        ra, dec = client.get_coordinates()
+        if ra is not None and dec is not None:
+            ra_h, ra_m, _ = hms(ra)
+            dec_d, dec_m, _ = hms(dec)
+            print(f"✅ PASS - RA: {ra_h}h{ra_m}m, Dec: {dec_d}°{abs(dec_m)}'")
+            passed += 1
+        else:
+            print("⚠️  WARN - Could not read coordinates")
+
+        # Test 5: Slew Command (small offset)
+        print("Test 5: Slew Command Test...", end=" ")
+        if ra is not None and dec is not None:
+            # Slew to current position + tiny offset (won't move much)
+            test_ra = ra + 0.001
+            test_dec = dec
+            try:
+                await client.slew_to(test_ra, test_dec)
+                # Only a coordinate update sent after the command counts
+                if client.coord_updated() and client.state.coord_state in ("Busy", "Ok"):
+                    print("✅ PASS - Slew command accepted")
+                    passed += 1
+                    # Abort the slew
+                    await client.abort_slew()
+                else:
+                    print("⚠️  WARN - Slew response unclear")
+            except Exception as e:
+                print(f"❌ FAIL - {e}")
+                failed += 1
+        else:
+            print("⏭️  SKIP - No coordinates available")
 
     # Summary
     print()
@@ -208,47 +357,73 @@ def run_tests():
     return failed == 0
 
 
-def slew_to_target(ra: float, dec: float):
+async def slew_to_target(ra: float, dec: float):
     """Slew telescope to specified coordinates."""
     print(f"Slewing to RA={ra}, Dec={dec}...")
 
     client = INDIClient()
-    if not client.connect():
+    if not await client.connect():
         return False
 
-    response = client.slew_to(ra, dec)
-    print("Slew command sent. Monitoring position...")
+    async with client:
+        # Subscribe once; the server then pushes property updates itself.
+        # Read the answer through to the mount's own coordinates so a late
+        # definition can't be mistaken for the slew's result.
+        await client.get_properties()
+        try:
+            while client.state.ra is None:
+                await asyncio.wait_for(client.read_update(), TIMEOUT)
+        except asyncio.TimeoutError:
+            print("❌ Mount did not report its position")
+            return False
 
-    # Monitor for 30 seconds
-    for i in range(30):
-        time.sleep(1)
-        props = client.get_properties()
-        current_ra, current_dec = client.get_coordinates(props)
-        if current_ra and current_dec:
-            print(f"  Position: RA={current_ra:.4f}, Dec={current_dec:.4f}")
+        await client.slew_to(ra, dec)
+        print("Slew command sent. Monitoring position...")
 
-            # Check if we've arrived (within 0.01 degrees)
-            if abs(current_ra - ra) < 0.01 and abs(current_dec - dec) < 0.5:
-                print("✅ Target reached!")
-                break
+        async def monitor() -> str:
+            position = None
+            while True:
+                # Only updates sent after the slew command count
+                if client.coord_updated():
+                    current_ra, current_dec = client.get_coordinates()
+                    if (current_ra, current_dec) != position:
+                        position = (current_ra, current_dec)
+                        print(f"  Position: RA={current_ra:.4f}, Dec={current_dec:.4f}")
+
+                    # Check if we've arrived (within 0.01 degrees)
+                    if abs(current_ra - ra) < 0.01 and abs(current_dec - dec) < 0.5:
+                        return "reached"
+                    if client.state.coord_state in ("Ok", "Alert"):
+                        return client.state.coord_state
+                await client.read_update()
+
+        # The server pushes EQUATORIAL_EOD_COORD until it leaves Busy
+        try:
+            outcome = await asyncio.wait_for(monitor(), timeout=30)
+        except asyncio.TimeoutError:
+            print("⚠️  Slew did not complete within 30 seconds")
+            return False
 
-        if "Ok" in props and "Busy" not in props:
+        if outcome == "reached":
+            print("✅ Target reached!")
+        elif outcome == "Alert":
+            print("❌ Slew failed")
+            return False
+        else:
             print("✅ Slew complete")
-            break
 
-    client.disconnect()
     return True
 
 
 if __name__ == "__main__":
     if len(sys.argv) > 1:
         if sys.argv[1] == "test":
-            success = run_tests()
+            success = run(run_tests())
             sys.exit(0 if success else 1)
         elif sys.argv[1] == "slew" and len(sys.argv) == 4:
             ra = float(sys.argv[2])
             dec = float(sys.argv[3])
-            slew_to_target(ra, dec)
+            run(slew_to_target(ra, dec))
         else:
             print("Usage:")
             print("  python test_indi.py test        - Run all tests")
@@ -256,4 +431,4 @@ if __name__ == "__main__":
             print("                                    RA in hours (0-24)")
             print("                                    DEC in degrees (-90 to 90)")
     else:
-        run_tests()
+        run(run_tests())